@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+import json
+import os
+import shutil
+from collections.abc import Iterable
+from pathlib import Path
+
+from .config import logger
+
+# --------------------------------------------------------------------------------------
+# Code
+# --------------------------------------------------------------------------------------
+
+
+class Checkpoint:
+    """Progress of a run, persisted so an interrupted run can be resumed.
+
+    A checkpoint lives in its own directory alongside the sorted runs it refers to.
+    It records which blobs are completed, i.e. fully contained in those runs.
+    Completed blob names are appended to a log, of which the checkpoint file records
+    the valid length, so saving takes time in proportion to the newly completed
+    blobs rather than all of them.
+    """
+
+    FILE_NAME = "checkpoint.json"
+    COMPLETED_FILE = "completed.log"
+
+    def __init__(self, directory: Path) -> None:
+        """Initialise an empty checkpoint, creating its directory if needed.
+
+        Args:
+            directory (Path): Directory to keep the checkpoint and its runs in.
+        """
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.completed: set[str] = set()
+        self.runs: dict[str, list[Path]] = {}
+        self._completed_bytes = 0
+
+    @classmethod
+    def load(cls, directory: Path) -> "Checkpoint":
+        """Load the checkpoint in a directory.
+
+        Run files not referred to by the checkpoint were written after it was saved,
+        and are removed, as their blobs will be processed again. So are completed
+        blobs logged after it was saved, and any other files or directories, e.g.
+        left by a merge that was interrupted.
+
+        Args:
+            directory (Path): Directory the checkpoint was saved in.
+
+        Returns:
+            Checkpoint: The loaded checkpoint, empty if none was saved.
+        """
+        checkpoint = cls(directory)
+        checkpoint_file = directory / cls.FILE_NAME
+        completed_file = directory / cls.COMPLETED_FILE
+        if checkpoint_file.exists():
+            state = json.loads(checkpoint_file.read_text())
+            checkpoint._completed_bytes = state["completed_bytes"]
+            os.truncate(completed_file, checkpoint._completed_bytes)
+            with completed_file.open() as f:
+                checkpoint.completed = {json.loads(line) for line in f}
+            checkpoint.runs = {
+                key: [directory / run for run in runs]
+                for key, runs in state["runs"].items()
+            }
+            logger().info(
+                "Resuming from checkpoint",
+                completed=len(checkpoint.completed),
+                directory=str(directory),
+            )
+        known = {
+            checkpoint_file,
+            completed_file,
+            *(run for runs in checkpoint.runs.values() for run in runs),
+        }
+        for path in directory.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path)
+            elif path not in known:
+                path.unlink()
+        return checkpoint
+
+    def save(self, completed: Iterable[str], runs: dict[str, list[Path]]) -> None:
+        """Save the checkpoint, atomically replacing the previous one.
+
+        New runs and completed blobs are synced to disk before the checkpoint refers
+        to them, and runs only the previous checkpoint referred to, e.g. compacted
+        ones, are removed once it has been replaced.
+
+        Args:
+            completed (Iterable[str]): Names of blobs completed since the last save,
+                fully contained in `runs`.
+            runs (dict[str, list[Path]]): Sorted run files per type name.
+        """
+        previous = {run for paths in self.runs.values() for run in paths}
+        self.runs = {key: list(paths) for key, paths in runs.items()}
+        current = {run for paths in self.runs.values() for run in paths}
+        for run in current - previous:
+            _fsync(run)
+        with (self.directory / self.COMPLETED_FILE).open("a") as f:
+            for name in completed:
+                if name not in self.completed:
+                    self.completed.add(name)
+                    f.write(f"{json.dumps(name)}\n")
+            f.flush()
+            os.fsync(f.fileno())
+            self._completed_bytes = f.tell()
+        state = {
+            "completed_bytes": self._completed_bytes,
+            "runs": {key: [p.name for p in paths] for key, paths in self.runs.items()},
+        }
+        tmp_file = self.directory / f"{self.FILE_NAME}.tmp"
+        with tmp_file.open("w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # Make new files durable before the checkpoint, and then the rename itself.
+        _fsync(self.directory)
+        os.replace(tmp_file, self.directory / self.FILE_NAME)
+        _fsync(self.directory)
+        for run in previous - current:
+            run.unlink()
+
+    def clear(self) -> None:
+        """Remove the checkpoint and its runs, once they are no longer needed."""
+        shutil.rmtree(self.directory)
+
+
+def _fsync(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def open_checkpoint(directory: Path, resume: bool = False) -> Checkpoint:
+    """Open the checkpoint in a directory, either resuming or starting afresh.
+
+    Args:
+        directory (Path): Directory to keep the checkpoint and its runs in.
+        resume (bool, optional): Whether to resume from a previously saved
+            checkpoint. Defaults to False, discarding any previous checkpoint.
+
+    Returns:
+        Checkpoint: The opened checkpoint.
+    """
+    if not resume and directory.exists():
+        shutil.rmtree(directory)
+    return Checkpoint.load(directory)
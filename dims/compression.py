@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+import gzip
+from io import BytesIO
+from io import TextIOWrapper
+from pathlib import Path
+from typing import Literal
+from typing import TextIO
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore[assignment]
+
+# --------------------------------------------------------------------------------------
+# Code
+# --------------------------------------------------------------------------------------
+
+Codec = Literal["gzip", "zstd"]
+
+# Errors raised when reading corrupt or truncated compressed data.
+DECOMPRESSION_ERRORS: tuple[type[Exception], ...] = (OSError, EOFError)
+if zstandard is not None:  # pragma: no branch
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+SUFFIXES: dict[str, Codec] = {
+    ".gz": "gzip",
+    ".gzip": "gzip",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+}
+
+# Valid compression levels per codec, inclusive.
+LEVELS: dict[Codec, tuple[int, int]] = {
+    "gzip": (0, 9),
+    "zstd": (1, 22),
+}
+
+
+def suffix(codec: Codec | None) -> str:
+    """Get the file suffix for a codec.
+
+    Args:
+        codec (Codec | None): The codec, or None for uncompressed files.
+
+    Returns:
+        str: The suffix, e.g. ".gz", or an empty string for uncompressed files.
+    """
+    match codec:
+        case "gzip":
+            return ".gz"
+        case "zstd":
+            return ".zst"
+    return ""
+
+
+def detect_codec(name: str, content_encoding: str | None = None) -> Codec | None:
+    """Detect the codec of a file from its content encoding or file extension.
+
+    Args:
+        name (str): Name of the file.
+        content_encoding (str | None, optional): Content-Encoding of the file.
+            Defaults to None.
+
+    Returns:
+        Codec | None: The detected codec, or None if the file is uncompressed.
+    """
+    match (content_encoding or "").lower():
+        case "gzip" | "x-gzip":
+            return "gzip"
+        case "zstd":
+            return "zstd"
+    return SUFFIXES.get(Path(name).suffix.lower())
+
+
+def _require_zstandard() -> None:
+    if zstandard is None:  # pragma: no cover
+        raise ImportError("zstd support requires zstandard: pip install dims[zstd]")
+
+
+def open_bytes(raw_data: bytes, codec: Codec | None) -> TextIO:
+    """Open raw, possibly compressed, bytes as text, decompressing while reading.
+
+    Args:
+        raw_data (bytes): The raw bytes to read.
+        codec (Codec | None): The codec the bytes are compressed with, if any.
+
+    Returns:
+        TextIO: A text stream suitable for csv reading.
+    """
+    match codec:
+        case "gzip":
+            return gzip.open(BytesIO(raw_data), "rt", encoding="utf-8", newline="")
+        case "zstd":
+            _require_zstandard()
+            return zstandard.open(BytesIO(raw_data), "rt", encoding="utf-8", newline="")
+    return TextIOWrapper(BytesIO(raw_data), encoding="utf-8", newline="")
+
+
+def open_file(
+    path: Path, mode: Literal["rt", "wt"] = "rt", level: int | None = None
+) -> TextIO:
+    """Open a csv file, (de)compressing it if its suffix calls for it.
+
+    Args:
+        path (Path): The file to open, e.g. LanderVenus.csv.gz.
+        mode (Literal["rt", "wt"], optional): Mode to open the file in.
+            Defaults to "rt".
+        level (int | None, optional): Compression level when writing. Defaults to
+            None, using the codec's default level.
+
+    Returns:
+        TextIO: A text stream suitable for csv reading or writing.
+    """
+    path = Path(path)
+    match detect_codec(path.name):
+        case "gzip":
+            compresslevel = 9 if level is None else level
+            return gzip.open(path, mode, compresslevel, newline="")
+        case "zstd":
+            _require_zstandard()
+            cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+            return zstandard.open(path, mode, cctx=cctx, newline="")
+    return path.open(mode, newline="")
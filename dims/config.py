@@ -4,10 +4,17 @@
 # --------------------------------------------------------------------------------------
 from functools import lru_cache
 from pathlib import Path
+from typing import Any
 from typing import Optional
 
 import structlog
 from pydantic import BaseSettings
+from pydantic import ByteSize
+from pydantic import PositiveInt
+from pydantic import validator
+
+from .compression import Codec
+from .compression import LEVELS
 
 # --------------------------------------------------------------------------------------
 # Code
@@ -18,8 +25,72 @@ class Settings(BaseSettings):
     """Settings via environment variables for use throughout the project."""
 
     bucket: str = "de-assignment-data-bucket"
+    source_dir: Optional[Path] = None
     output_dir: Path = Path.cwd() / "data"
+    output_compression: Optional[Codec] = None
+    compression_level: Optional[int] = None
     max_results: Optional[int] = None
+    memory_budget: Optional[ByteSize] = None
+    checkpoint_interval: Optional[PositiveInt] = None
+    resume: bool = False
+    profile: bool = False
+    shard_count: int = 1
+    shard_index: int = 0
+
+    @validator("compression_level")
+    def compression_level_in_range(
+        cls, compression_level: Optional[int], values: dict[str, Any]
+    ) -> Optional[int]:
+        """Make sure the compression level is valid for the output codec.
+
+        Args:
+            compression_level (Optional[int]): The compression level, if any.
+            values (dict[str, Any]): Previously validated fields.
+
+        Returns:
+            Optional[int]: The validated compression level.
+        """
+        if compression_level is None:
+            return compression_level
+        codec = values.get("output_compression")
+        if codec is None:
+            raise ValueError("compression_level requires output_compression to be set")
+        low, high = LEVELS[codec]
+        if not low <= compression_level <= high:
+            raise ValueError(
+                f"compression_level for {codec} must be in the range [{low}, {high}]"
+            )
+        return compression_level
+
+    @validator("shard_count")
+    def shard_count_positive(cls, shard_count: int) -> int:
+        """Make sure we have at least one shard to put blobs in.
+
+        Args:
+            shard_count (int): The total number of shards.
+
+        Returns:
+            int: The validated shard count.
+        """
+        if shard_count < 1:
+            raise ValueError("shard_count must be at least 1")
+        return shard_count
+
+    @validator("shard_index")
+    def shard_index_in_range(cls, shard_index: int, values: dict[str, Any]) -> int:
+        """Make sure the shard index is one of the available shards.
+
+        Args:
+            shard_index (int): The zero-based index of this worker's shard.
+            values (dict[str, Any]): Previously validated fields.
+
+        Returns:
+            int: The validated shard index.
+        """
+        shard_count = values.get("shard_count", 1)
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"shard_index must be in the range [0, {shard_count})")
+        return shard_index
 
 
 @lru_cache(maxsize=32)
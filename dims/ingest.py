@@ -3,19 +3,31 @@
 # Imports
 # --------------------------------------------------------------------------------------
 import csv
+import hashlib
 from collections.abc import Iterator
-from io import StringIO
+from itertools import islice
+from pathlib import Path
 from typing import NamedTuple
+from typing import TypeAlias
 
 from google.cloud import storage
+from more_itertools import peekable
 
+from .compression import DECOMPRESSION_ERRORS
+from .compression import detect_codec
+from .compression import open_bytes
 from .config import logger
+from .tracing import Tracer
 
 # --------------------------------------------------------------------------------------
 # Code
 # --------------------------------------------------------------------------------------
 
 
+# Errors raised when blob data can't be read as csv.
+PARSE_ERRORS: tuple[type[Exception], ...] = (csv.Error, *DECOMPRESSION_ERRORS)
+
+
 class BlobData(NamedTuple):
     """Collection of BlobData."""
 
@@ -23,6 +35,37 @@ class BlobData(NamedTuple):
     data: list[dict[str, str]]
 
 
+class LocalBlob(NamedTuple):
+    """A file on the local filesystem, standing in for a storage.Blob."""
+
+    path: Path
+
+    @property
+    def name(self) -> str:
+        """Name of the blob, i.e. the name of the file."""
+        return self.path.name
+
+    @property
+    def content_encoding(self) -> None:
+        """Content encoding of the blob, which local files don't have."""
+        return None
+
+    def download_as_bytes(self, raw_download: bool = False) -> bytes:
+        """Read the file contents, mirroring storage.Blob.download_as_bytes.
+
+        Args:
+            raw_download (bool, optional): Unused, files are always read as is.
+                Defaults to False.
+
+        Returns:
+            bytes: The raw file contents.
+        """
+        return self.path.read_bytes()
+
+
+Blob: TypeAlias = storage.Blob | LocalBlob
+
+
 def get_blobs(
     bucket_name: str, max_results: int | None = None
 ) -> Iterator[storage.Blob]:
@@ -40,23 +83,141 @@ def get_blobs(
     return client.list_blobs(bucket_name, max_results)
 
 
-def get_blob_data(blob: storage.Blob) -> BlobData:
+def get_local_blobs(
+    source_dir: Path, max_results: int | None = None
+) -> Iterator[LocalBlob]:
+    """Get blobs from a directory on the local filesystem.
+
+    Files are returned in sorted order, so every caller sees the same listing.
+
+    Args:
+        source_dir (Path): Directory to get blobs from.
+        max_results (int | None, optional): Maximum number of blobs to return.
+            Defaults to None.
+
+    Returns:
+        Iterator[LocalBlob]: An iterator of blobs in the given directory.
+    """
+    paths = sorted(path for path in source_dir.iterdir() if path.is_file())
+    return islice(map(LocalBlob, paths), max_results)
+
+
+def blob_shard(blob_name: str, shard_count: int) -> int:
+    """Deterministically assign a blob to one of `shard_count` shards.
+
+    The built-in `hash` is salted per process, so a stable digest is used instead.
+    This way every worker agrees on the assignment without coordinating.
+
+    Args:
+        blob_name (str): Name of the blob to assign.
+        shard_count (int): The total number of shards.
+
+    Returns:
+        int: The zero-based index of the shard owning the blob.
+    """
+    digest = hashlib.blake2b(blob_name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+def iter_blob_rows(
+    name: str, raw_data: bytes, content_encoding: str | None = None
+) -> Iterator[dict[str, str]]:
+    """Iterate over csv rows in dictionary format from the raw bytes of a blob.
+
+    Compressed blobs are detected by their content encoding or file extension and
+    decompressed while iterating, so only the current row is held in memory.
+
+    Args:
+        name (str): Name of the blob.
+        raw_data (bytes): The raw, possibly compressed, bytes of the blob.
+        content_encoding (str | None, optional): Content-Encoding of the blob.
+            Defaults to None.
+
+    Yields:
+        dict[str, str]: The next csv row.
+
+    Raises:
+        csv.Error: If the blob is not valid csv, or one of DECOMPRESSION_ERRORS
+            if it is not valid compressed data.
+    """
+    with open_bytes(raw_data, detect_codec(name, content_encoding)) as f:
+        for row in csv.DictReader(f):
+            row.setdefault("timestamp", name)
+            yield row
+
+
+def download_blob(blob: Blob, tracer: Tracer | None = None) -> bytes:
+    """Download the raw bytes of a blob.
+
+    Blobs are downloaded raw, so we decompress them ourselves instead of relying on
+    transcoding.
+
+    Args:
+        blob (Blob): The blob to download.
+        tracer (Tracer | None, optional): Tracer to record the download with.
+            Defaults to None.
+
+    Returns:
+        bytes: The raw, possibly compressed, bytes of the blob.
+    """
+    tracer = tracer or Tracer()
+    with tracer.span("download", blob=blob.name) as span:
+        raw_data = blob.download_as_bytes(raw_download=True)
+        span["bytes"] = len(raw_data)
+    return raw_data
+
+
+def iter_blob_data(
+    blob: Blob,
+    raw_data: bytes,
+    batch_size: int | None = None,
+    tracer: Tracer | None = None,
+) -> Iterator[BlobData]:
+    """Iterate over the csv data of a downloaded blob in batches of rows.
+
+    Rows are decoded a batch at a time, so only the current batch is held in memory
+    next to the raw bytes. Only a blob without rows gives an empty batch.
+
+    Args:
+        blob (Blob): The blob the data was downloaded from.
+        raw_data (bytes): The raw bytes of the blob, see `download_blob`.
+        batch_size (int | None, optional): Number of rows per batch. Defaults to
+            None, giving all rows in a single batch.
+        tracer (Tracer | None, optional): Tracer to record decoding with.
+            Defaults to None.
+
+    Yields:
+        BlobData: The name of the blob and the next batch of its csv data.
+
+    Raises:
+        csv.Error: If the blob is not valid csv, or one of DECOMPRESSION_ERRORS
+            if it is not valid compressed data.
+    """
+    tracer = tracer or Tracer()
+    rows = peekable(iter_blob_rows(blob.name, raw_data, blob.content_encoding))
+    more = True
+    while more:
+        with tracer.span("decode", blob=blob.name) as span:
+            batch = list(islice(rows, batch_size))
+            # Look ahead, so a blob with rows never ends in an empty batch.
+            more = bool(rows)
+            span["rows"] = len(batch)
+        yield BlobData(blob.name, batch)
+
+
+def get_blob_data(blob: Blob) -> BlobData:
     """Get csv file names and data in dictionary format from a given blob.
 
     Args:
-        blob (storage.Blob): The blob to download data from.
+        blob (Blob): The blob to download data from.
 
     Returns:
-        list[dict[str, str]]: A list containing a dictionary representation of csv data.
+        BlobData: The name of the blob and its csv data as dictionaries.
     """
-    raw_data = blob.download_as_bytes()
+    raw_data = download_blob(blob)
     try:
-        csv_data: list[dict[str, str]] = list(
-            csv.DictReader(StringIO(raw_data.decode()))
-        )
-    except csv.Error as e:
+        (blob_data,) = iter_blob_data(blob, raw_data)
+    except PARSE_ERRORS as e:
         logger().error("Failed to parse blob data", error=str(e))
-        csv_data = []
-    for d in csv_data:
-        d.setdefault("timestamp", blob.name)
-    return BlobData(blob.name, csv_data)
+        blob_data = BlobData(blob.name, [])
+    return blob_data
@@ -3,24 +3,54 @@
 # Imports
 # --------------------------------------------------------------------------------------
 import re
+from collections import Counter
+from contextlib import ExitStack
+from functools import partial
 from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from typing import Union
 
 from more_itertools import bucket
-from more_itertools import flatten
+from pydantic import ByteSize
 from pydantic import parse_obj_as
 from tqdm import tqdm
 
+from dims import compression
 from dims import config
 from dims import ingest
+from dims import memory
 from dims import models
 from dims import output
+from dims import tracing
+from dims.checkpoint import open_checkpoint
 
 # --------------------------------------------------------------------------------------
 # Code
 # --------------------------------------------------------------------------------------
 
 
+def blob_model(name: str) -> type[models.CraftBase] | None:
+    """Get the model to parse a blob's data into from the name of the blob.
+
+    Args:
+        name (str): Name of the blob, e.g. lander_venus_20210301_003124.csv.
+
+    Returns:
+        type[models.CraftBase] | None: The model, or None if the blob is unknown.
+    """
+    match name:
+        case name if re.match(r".*lander_saturn.*", name):
+            return models.LanderSaturn
+        case name if re.match(r".*lander_venus.*", name):
+            return models.LanderVenus
+        case name if re.match(r".*rocket_saturn.*", name):
+            return models.RocketSaturn
+        case name if re.match(r".*rocket_venus.*", name):
+            return models.RocketVenus
+    return None
+
+
 def parse_models(
     blob_data: ingest.BlobData,
 ) -> Union[
@@ -41,56 +71,229 @@ def parse_models(
             List of data parsed into correct model.
 
     """
-    match blob_data:
-        case blob_data if re.match(r".*lander_saturn.*", blob_data.name):
-            return parse_obj_as(list[models.LanderSaturn], blob_data.data)
-        case blob_data if re.match(r".*lander_venus.*", blob_data.name):
-            return parse_obj_as(list[models.LanderVenus], blob_data.data)
-        case blob_data if re.match(r".*rocket_saturn.*", blob_data.name):
-            return parse_obj_as(list[models.RocketSaturn], blob_data.data)
-        case blob_data if re.match(r".*rocket_venus.*", blob_data.name):
-            return parse_obj_as(list[models.RocketVenus], blob_data.data)
+    model = blob_model(blob_data.name)
+    if model is None:
+        config.logger().error("File not parsed", file_name=blob_data.name)
+        return []
+    return parse_obj_as(list[model], blob_data.data)  # type: ignore[valid-type]
 
-    config.logger().error("File not parsed", file_name=blob_data.name)
-    return []
+
+def process_blob(
+    blob: ingest.Blob,
+    batch_size: int | None = None,
+    tracer: tracing.Tracer | None = None,
+) -> tuple[str, list[models.CraftBase]]:
+    """Download a blob and parse its data into models in batches.
+
+    Rows are read from the blob a batch at a time, and each batch is dropped once it
+    is parsed, so only one batch of rows is held in memory next to the models.
+    If the blob turns out not to be valid csv, none of its crafts are returned, and
+    blobs of unknown types are skipped without downloading them.
+
+    Args:
+        blob (ingest.Blob): The blob to download and parse.
+        batch_size (int | None, optional): Number of rows to parse at a time.
+            Defaults to None, parsing all rows at once.
+        tracer (tracing.Tracer | None, optional): Tracer to record the download,
+            decode and validate stages with. Defaults to None.
+
+    Returns:
+        tuple[str, list[models.CraftBase]]: The name of the blob and parsed crafts.
+    """
+    model = blob_model(blob.name)
+    if model is None:
+        config.logger().error("File not parsed", file_name=blob.name)
+        return blob.name, []
+
+    tracer = tracer or tracing.Tracer()
+    raw_data = ingest.download_blob(blob, tracer)
+    crafts: list[models.CraftBase] = []
+    try:
+        for blob_data in ingest.iter_blob_data(blob, raw_data, batch_size, tracer):
+            with tracer.span("validate", blob=blob.name) as span:
+                parsed = parse_obj_as(
+                    list[model], blob_data.data  # type: ignore[valid-type]
+                )
+                span["rows"] = len(parsed)
+            crafts.extend(parsed)
+    except ingest.PARSE_ERRORS as e:
+        config.logger().error("Failed to parse blob data", error=str(e))
+        crafts = []
+    return blob.name, crafts
 
 
 def main() -> None:
     """Main entrypoint.
 
     This function
-        - gets blob data using bucket name and max results from settings,
+        - gets blob data using bucket name (or source directory) and max results
+          from settings,
+        - keeps only the blobs belonging to this worker's shard,
         - uses a thread pool to download and parse data, and
         - groups data by type and outputs it to CSV to the output directory
           given in settings.
+
+    If a memory budget is given in settings, the number of blobs in flight, parsing
+    batch sizes and the number of rows held before spilling sorted runs to disk are
+    derived from it. Peak memory usage is logged at the end of the run.
+
+    When running with more than one shard, each worker outputs its own shard files,
+    which are combined afterwards using `merge`.
+
+    If a checkpoint interval is given in settings, sorted runs are spilled and a
+    checkpoint of completed blobs is saved every so many blobs. Resuming picks up
+    from the last checkpoint, skipping completed blobs.
+
+    In profile mode, the list, download, decode, validate and write stages are
+    traced and profiled, and the results are written to a profile directory in the
+    output directory.
     """
     settings = config.get_settings()
-    blobs = list(ingest.get_blobs(settings.bucket, settings.max_results))
+    shard = f"{settings.shard_index:05d}-of-{settings.shard_count:05d}"
+    profile_dir = settings.output_dir / "profile"
+    if settings.shard_count > 1:
+        # Sharded workers share the output directory, so each profiles to its own.
+        profile_dir /= f"shard-{shard}"
+    tracer = tracing.Tracer(settings.profile)
+    try:
+        with tracer.span("list") as span:
+            if settings.source_dir is not None:
+                all_blobs = ingest.get_local_blobs(
+                    settings.source_dir, settings.max_results
+                )
+            else:
+                all_blobs = ingest.get_blobs(settings.bucket, settings.max_results)
+            blobs = [
+                blob
+                for blob in all_blobs
+                if ingest.blob_shard(blob.name, settings.shard_count)
+                == settings.shard_index
+            ]
+            span["blobs"] = len(blobs)
 
-    with ThreadPool() as pool:
-        craft_data = list(
-            tqdm(
-                pool.imap_unordered(ingest.get_blob_data, blobs),
-                total=len(blobs),
-                desc="Downloading data",
+        checkpoint = None
+        if settings.resume or settings.checkpoint_interval is not None:
+            checkpoint = open_checkpoint(
+                settings.output_dir / f".checkpoint-{shard}", settings.resume
             )
+            blobs = [blob for blob in blobs if blob.name not in checkpoint.completed]
+
+        memory_budget = settings.memory_budget
+        headroom = (
+            None if memory_budget is None else memory_budget - memory.current_rss()
         )
-        parsed_crafts = list(
-            tqdm(
-                pool.imap_unordered(parse_models, craft_data),
-                total=len(craft_data),
-                desc="Parsing data",
+        sizes = memory.pipeline_sizes(headroom)
+        limiter = memory.InFlightLimiter(sizes.in_flight, memory_budget)
+
+        # Blobs completed since the last checkpoint.
+        completed: list[str] = []
+        with ExitStack() as stack:
+            if checkpoint is not None:
+                sorter = output.SpillingSorter(
+                    checkpoint.directory, sizes.spill_rows, checkpoint.runs, tracer
+                )
+            else:
+                spill_dir = stack.enter_context(
+                    TemporaryDirectory(dir=settings.output_dir)
+                )
+                sorter = output.SpillingSorter(
+                    Path(spill_dir), sizes.spill_rows, tracer=tracer
+                )
+            with ThreadPool() as pool, limiter:
+                for name, crafts in tqdm(
+                    pool.imap_unordered(
+                        partial(
+                            process_blob, batch_size=sizes.batch_size, tracer=tracer
+                        ),
+                        limiter.throttle(blobs),
+                    ),
+                    total=len(blobs),
+                    desc="Processing data",
+                ):
+                    sorter.add(crafts)
+                    limiter.release()
+                    if checkpoint is not None:
+                        completed.append(name)
+                    # Spill early rather than running out of memory.
+                    if memory.over_budget(memory_budget) and sorter.rows:
+                        sorter.spill()
+                    if (
+                        checkpoint is not None
+                        and settings.checkpoint_interval is not None
+                        and len(completed) >= settings.checkpoint_interval
+                    ):
+                        # Everything completed so far must be on disk first.
+                        sorter.spill()
+                        sorter.compact()
+                        checkpoint.save(completed, sorter.runs)
+                        completed.clear()
+
+            sorter.write(
+                lambda key: output.shard_file(
+                    settings.output_dir,
+                    key,
+                    settings.shard_index,
+                    settings.shard_count,
+                    settings.output_compression,
+                ),
+                settings.compression_level,
             )
-        )
+        if checkpoint is not None:
+            checkpoint.clear()
+    finally:
+        # Export even if the run fails, so failing runs can be profiled too.
+        tracer.export(profile_dir)
+
+    config.logger().info(
+        "Peak memory usage",
+        peak_rss=ByteSize(memory.peak_rss()).human_readable(),
+        memory_budget=memory_budget and memory_budget.human_readable(),
+    )
+
 
-    # Bucket by type name, e.g. LanderVenus.
-    buckets = bucket(flatten(parsed_crafts), lambda craft: type(craft).__name__)
-    for key in list(buckets):
-        crafts = list(buckets[key])
-        # Sort by timestamp because data might be
-        # in any order after using imap_unordered.
-        crafts.sort(key=lambda craft: craft.timestamp)
-        output.crafts_to_csv(crafts, settings.output_dir / f"{key}.csv")
+def merge() -> None:
+    """Merge entrypoint.
+
+    This function combines the shard files written by sharded `main` runs in the
+    output directory given in settings into one timestamp-ordered CSV per type.
+    Types are merged in parallel, so (de)compression overlaps with reading and
+    writing.
+
+    Raises:
+        ValueError: If the shard files come from runs with different shard counts,
+            or a shard appears more than once, e.g. with different compression
+            suffixes. These are leftovers from earlier runs, and merging them would
+            duplicate rows.
+    """
+    settings = config.get_settings()
+    shard_paths = sorted(settings.output_dir.glob("*.shard-*-of-*.csv*"))
+    shard_counts = {output.shard_count_of(path) for path in shard_paths}
+    if len(shard_counts) > 1:
+        raise ValueError(
+            f"Found shard files for different shard counts {sorted(shard_counts)} "
+            f"in {settings.output_dir}, remove the ones left from earlier runs"
+        )
+    shards = Counter(path.name.split(".csv")[0] for path in shard_paths)
+    duplicates = sorted(shard for shard, count in shards.items() if count > 1)
+    if duplicates:
+        raise ValueError(
+            f"Found shard files for {duplicates} more than once "
+            f"in {settings.output_dir}, remove the ones left from earlier runs"
+        )
+    shard_files = bucket(shard_paths, lambda path: path.name.split(".")[0])
+    out_suffix = compression.suffix(settings.output_compression)
+    with ThreadPool() as pool:
+        pool.starmap(
+            output.merge_csv_shards,
+            [
+                (
+                    list(shard_files[key]),
+                    settings.output_dir / f"{key}.csv{out_suffix}",
+                    settings.compression_level,
+                )
+                for key in list(shard_files)
+            ],
+        )
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+import os
+import resource
+import threading
+from collections.abc import Iterable
+from collections.abc import Iterator
+from typing import NamedTuple
+from typing import TypeVar
+
+# --------------------------------------------------------------------------------------
+# Code
+# --------------------------------------------------------------------------------------
+
+T = TypeVar("T")
+
+# Rough in-memory size of a single row, first as a dict and then as a model.
+ROW_BYTES = 2 * 1024
+# Number of rows in a typical blob.
+BLOB_ROWS = 1000
+# Fraction of the budget at which we start spilling and slowing down.
+PRESSURE = 0.9
+
+
+class PipelineSizes(NamedTuple):
+    """Sizes bounding the memory used by each stage of the pipeline.
+
+    A size of None means unbounded.
+    """
+
+    in_flight: int | None
+    batch_size: int | None
+    spill_rows: int | None
+
+
+def pipeline_sizes(headroom: int | None) -> PipelineSizes:
+    """Derive pipeline sizes from the memory available to the pipeline.
+
+    A quarter of the headroom goes to blobs being downloaded and parsed, another
+    quarter to the batches of rows being parsed into models, and the remaining half to
+    rows buffered for output before they are spilled to disk.
+
+    Args:
+        headroom (int | None): Bytes available to the pipeline, or None if unbounded.
+
+    Returns:
+        PipelineSizes: The sizes to use for the pipeline.
+    """
+    if headroom is None:
+        return PipelineSizes(None, None, None)
+    headroom = max(headroom, 0)
+    in_flight = max(1, headroom // 4 // (BLOB_ROWS * ROW_BYTES))
+    batch_size = max(1, headroom // 4 // in_flight // ROW_BYTES)
+    spill_rows = max(BLOB_ROWS, headroom // 2 // ROW_BYTES)
+    return PipelineSizes(in_flight, batch_size, spill_rows)
+
+
+def peak_rss() -> int:
+    """Get the peak resident set size of this process.
+
+    Returns:
+        int: Peak resident set size in bytes.
+    """
+    # ru_maxrss is given in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss() -> int:
+    """Get the current resident set size of this process.
+
+    Falls back to the peak resident set size where /proc is unavailable.
+
+    Returns:
+        int: Current resident set size in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # pragma: no cover
+        return peak_rss()
+
+
+def over_budget(memory_budget: int | None) -> bool:
+    """Check whether memory usage is approaching the budget.
+
+    Args:
+        memory_budget (int | None): Memory budget in bytes, or None if unbounded.
+
+    Returns:
+        bool: True if the current resident set size is close to the budget.
+    """
+    return memory_budget is not None and current_rss() >= memory_budget * PRESSURE
+
+
+class InFlightLimiter:
+    """Limit the number of items being worked on at once.
+
+    When memory usage approaches the budget, only one item is let through at a time
+    until usage drops again. Use the limiter as a context manager, so that it stops
+    blocking once the items are no longer being consumed, e.g. after an error.
+    """
+
+    def __init__(self, limit: int | None, memory_budget: int | None = None) -> None:
+        """Initialise the limiter.
+
+        Args:
+            limit (int | None): Maximum number of items in flight, None if unbounded.
+            memory_budget (int | None, optional): Memory budget in bytes.
+                Defaults to None.
+        """
+        self.limit = limit
+        self.memory_budget = memory_budget
+        self.in_flight = 0
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def __enter__(self) -> "InFlightLimiter":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def _can_start(self) -> bool:
+        if self.closed:
+            return True
+        if over_budget(self.memory_budget):
+            return self.in_flight == 0
+        return self.limit is None or self.in_flight < self.limit
+
+    def throttle(self, items: Iterable[T]) -> Iterator[T]:
+        """Yield items, blocking while too many are in flight.
+
+        Args:
+            items (Iterable[T]): Items to yield.
+
+        Yields:
+            T: The next item, once there is room for it.
+        """
+        for item in items:
+            with self._condition:
+                self._condition.wait_for(self._can_start)
+                if self.closed:
+                    return
+                self.in_flight += 1
+            yield item
+
+    def release(self) -> None:
+        """Mark an item as done, making room for the next one."""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """Stop yielding items, unblocking any waiting `throttle`."""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
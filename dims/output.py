@@ -3,11 +3,25 @@
 # Imports
 # --------------------------------------------------------------------------------------
 import csv
+import heapq
+import os
+import re
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import ExitStack
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
+from tempfile import mkstemp
+from tempfile import TemporaryDirectory
 
+from more_itertools import chunked
 from tqdm import tqdm
 
+from .compression import Codec
+from .compression import open_file
+from .compression import suffix
 from .models import CraftBase
+from .tracing import Tracer
 from dims.config import logger
 
 # --------------------------------------------------------------------------------------
@@ -15,20 +29,249 @@ from dims.config import logger
 # --------------------------------------------------------------------------------------
 
 
-def crafts_to_csv(models: list[CraftBase], out_file: Path) -> None:
+def crafts_to_csv(
+    models: list[CraftBase], out_file: Path, level: int | None = None
+) -> None:
     """Generate csv file from craft model data.
 
+    The file is compressed if its suffix calls for it, e.g. LanderVenus.csv.gz.
+
     Args:
         models (list[CraftBase]): Crafts to output
         out_file (Path): File to output data to.
+        level (int | None, optional): Compression level. Defaults to None.
     """
     if not models:
         logger().warn("No data to output")
         return None
 
     fieldnames = models[0].__fields__
-    with out_file.open("w") as f:
+    with open_file(out_file, "wt", level) as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames, escapechar="\n")
         writer.writeheader()
         for model in tqdm(models, desc=f"Outputting {out_file}"):
             writer.writerow(model.dict())
+
+
+# --------------------------------------------------------------------------------------
+# Shards
+# --------------------------------------------------------------------------------------
+
+# Maximum number of files to merge at once, keeping open file handles bounded.
+MERGE_LIMIT = 64
+
+
+def shard_file(
+    out_dir: Path,
+    key: str,
+    shard_index: int,
+    shard_count: int,
+    codec: Codec | None = None,
+) -> Path:
+    """Get the output file for one shard of a craft type.
+
+    Without sharding, this is simply the final output file, e.g. LanderVenus.csv.
+
+    Args:
+        out_dir (Path): Directory to output data to.
+        key (str): Craft type name, e.g. LanderVenus.
+        shard_index (int): The zero-based index of the shard.
+        shard_count (int): The total number of shards.
+        codec (Codec | None, optional): Codec to compress output with.
+            Defaults to None.
+
+    Returns:
+        Path: The file to output the shard to.
+    """
+    if shard_count == 1:
+        return out_dir / f"{key}.csv{suffix(codec)}"
+    shard = f"shard-{shard_index:05d}-of-{shard_count:05d}"
+    return out_dir / f"{key}.{shard}.csv{suffix(codec)}"
+
+
+def shard_count_of(path: Path) -> int:
+    """Get the total number of shards from the name of an output file.
+
+    Args:
+        path (Path): The file to check, e.g. LanderVenus.shard-00002-of-00004.csv.
+
+    Returns:
+        int: The total number of shards, 1 if the file is not a shard.
+    """
+    match = re.search(r"\.shard-\d+-of-(\d+)\.csv", path.name)
+    return int(match.group(1)) if match else 1
+
+
+def merge_csv_shards(
+    shard_files: list[Path], out_file: Path, level: int | None = None
+) -> int:
+    """Merge timestamp-ordered csv shards into a single timestamp-ordered csv file.
+
+    Shards are streamed rather than read into memory, as each of them is sorted.
+    At most MERGE_LIMIT shards are open at once: with more shards than that, they
+    are first merged in groups into intermediate files, in as many passes as needed.
+    Shards and output are (de)compressed according to their suffixes.
+
+    Args:
+        shard_files (list[Path]): Shards to merge, all with the same header.
+        out_file (Path): File to output merged data to.
+        level (int | None, optional): Compression level. Defaults to None.
+
+    Returns:
+        int: The number of rows merged.
+    """
+    if not shard_files:
+        logger().warn("No shards to merge")
+        return 0
+
+    if len(shard_files) > MERGE_LIMIT:
+        with TemporaryDirectory(dir=out_file.parent) as tmp_dir:
+            # Merging consecutive groups keeps rows with equal timestamps in order.
+            groups = list(chunked(shard_files, MERGE_LIMIT))
+            merged = [Path(tmp_dir) / f"merged-{i:05d}.csv" for i in range(len(groups))]
+            for group, merged_file in zip(groups, merged):
+                merge_csv_shards(group, merged_file)
+            return merge_csv_shards(merged, out_file, level)
+
+    with ExitStack() as stack:
+        readers = [
+            csv.DictReader(stack.enter_context(open_file(shard)))
+            for shard in shard_files
+        ]
+        fieldnames = readers[0].fieldnames or []
+        f = stack.enter_context(open_file(out_file, "wt", level))
+        writer = csv.DictWriter(f, fieldnames=fieldnames, escapechar="\n")
+        writer.writeheader()
+        rows = heapq.merge(*readers, key=lambda row: row["timestamp"])
+        count = 0
+        for count, row in enumerate(tqdm(rows, desc=f"Merging {out_file}"), 1):
+            writer.writerow(row)
+    return count
+
+
+# --------------------------------------------------------------------------------------
+# Sorting
+# --------------------------------------------------------------------------------------
+
+
+class SpillingSorter:
+    """Group crafts by type and sort them by timestamp, spilling to disk if needed.
+
+    Crafts are buffered in memory until more than `spill_rows` rows are held, at
+    which point each buffer is sorted and written to a run file in `spill_dir`.
+    Runs are merged when the final output is written, or earlier by `compact`.
+    """
+
+    def __init__(
+        self,
+        spill_dir: Path,
+        spill_rows: int | None = None,
+        runs: dict[str, list[Path]] | None = None,
+        tracer: Tracer | None = None,
+    ) -> None:
+        """Initialise the sorter.
+
+        Args:
+            spill_dir (Path): Directory to write sorted runs to.
+            spill_rows (int | None, optional): Number of buffered rows to spill at.
+                Defaults to None, never spilling on its own.
+            runs (dict[str, list[Path]] | None, optional): Previously spilled runs
+                per type name, e.g. from a checkpoint. Defaults to None.
+            tracer (Tracer | None, optional): Tracer to record writes with.
+                Defaults to None.
+        """
+        self.spill_dir = spill_dir
+        self.spill_rows = spill_rows
+        self.rows = 0
+        self.buffers: defaultdict[str, list[CraftBase]] = defaultdict(list)
+        self.runs: defaultdict[str, list[Path]] = defaultdict(list)
+        for key, paths in (runs or {}).items():
+            self.runs[key].extend(paths)
+        self.tracer = tracer or Tracer()
+
+    def add(self, crafts: list[CraftBase]) -> None:
+        """Add crafts to the buffers, spilling if the threshold is exceeded.
+
+        Args:
+            crafts (list[CraftBase]): Crafts to add.
+        """
+        for craft in crafts:
+            # Bucket by type name, e.g. LanderVenus.
+            self.buffers[type(craft).__name__].append(craft)
+        self.rows += len(crafts)
+        if self.spill_rows is not None and self.rows > self.spill_rows:
+            self.spill()
+
+    def spill(self) -> None:
+        """Sort the buffered crafts and write them to run files."""
+        for key, crafts in self.buffers.items():
+            run_file = self._run_file(key)
+            crafts.sort(key=lambda craft: craft.timestamp)
+            self._write_crafts(crafts, run_file)
+            self.runs[key].append(run_file)
+        self.buffers.clear()
+        self.rows = 0
+
+    def compact(self) -> None:
+        """Merge the runs of each type with MERGE_LIMIT or more runs into one run.
+
+        This keeps the number of run files bounded when spilling often, e.g. at
+        every checkpoint. The merged runs are left in place, for the caller to
+        remove once nothing refers to them any more.
+        """
+        for key, runs in self.runs.items():
+            if len(runs) >= MERGE_LIMIT:
+                run_file = self._run_file(key)
+                merge_csv_shards(runs, run_file)
+                self.runs[key] = [run_file]
+
+    def write(self, out_file: Callable[[str], Path], level: int | None = None) -> None:
+        """Write the sorted crafts of each type to their output file.
+
+        Types are written in parallel, so compression overlaps with writing.
+
+        Args:
+            out_file (Callable[[str], Path]): Gives the output file for a type name.
+            level (int | None, optional): Compression level. Defaults to None.
+        """
+        if self.runs:
+            self.spill()
+            with ThreadPool() as pool:
+                pool.starmap(
+                    self._merge_runs,
+                    [(runs, out_file(key), level) for key, runs in self.runs.items()],
+                )
+            return None
+
+        for crafts in self.buffers.values():
+            # Sort by timestamp because data might be
+            # in any order after using imap_unordered.
+            crafts.sort(key=lambda craft: craft.timestamp)
+        with ThreadPool() as pool:
+            pool.starmap(
+                self._write_crafts,
+                [
+                    (crafts, out_file(key), level)
+                    for key, crafts in self.buffers.items()
+                ],
+            )
+
+    def _run_file(self, key: str) -> Path:
+        # Unique names, as compacted runs may be replaced while still referred to.
+        fd, run_file = mkstemp(".csv", f"{key}.run-", self.spill_dir)
+        os.close(fd)
+        return Path(run_file)
+
+    def _write_crafts(
+        self, crafts: list[CraftBase], out_file: Path, level: int | None = None
+    ) -> None:
+        with self.tracer.span("write", file=out_file.name, rows=len(crafts)) as span:
+            crafts_to_csv(crafts, out_file, level)
+            span["bytes"] = out_file.stat().st_size
+
+    def _merge_runs(
+        self, runs: list[Path], out_file: Path, level: int | None = None
+    ) -> None:
+        with self.tracer.span("write", file=out_file.name) as span:
+            span["rows"] = merge_csv_shards(runs, out_file, level)
+            span["bytes"] = out_file.stat().st_size
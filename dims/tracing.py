@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+from .config import logger
+
+# --------------------------------------------------------------------------------------
+# Code
+# --------------------------------------------------------------------------------------
+
+# From Python 3.12, cProfile is built on sys.monitoring, which is process-wide: a
+# profiler records the calls of every thread, and only one can be enabled at a time.
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+# Stage of the single profiler used when per thread profiles are unavailable.
+ALL_STAGES = "all"
+
+
+class Tracer:
+    """Record spans of pipeline stages, and profile them, when enabled.
+
+    Spans are exported as Chrome trace events, which can be opened in Perfetto or
+    chrome://tracing. Each span records its wall and thread CPU time, so a large gap
+    between the two shows a thread waiting on I/O or the GIL.
+
+    Stages are profiled with a cProfile profiler per stage and thread. Nested spans
+    are not profiled separately, and neither are spans started while another
+    profiler is active. From Python 3.12, where profilers are process-wide, a single
+    profiler instead records all stages and threads, for as long as any span is open.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        """Initialise the tracer.
+
+        Args:
+            enabled (bool, optional): Whether to record anything. Defaults to False.
+        """
+        self.enabled = enabled
+        self.events: list[dict[str, Any]] = []
+        self.profiles: dict[tuple[str, str | None], cProfile.Profile] = {}
+        # Names are recorded along with spans, as threads may be gone by export.
+        self.thread_names: dict[int | None, str] = {}
+        self._start = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open_spans = 0
+
+    def _profile(self, stage: str) -> cProfile.Profile | None:
+        if not PER_THREAD_PROFILES:
+            return self._profile_process()
+        if getattr(self._local, "profiling", False):
+            return None
+        key = (stage, threading.current_thread().name)
+        with self._lock:
+            profile = self.profiles.setdefault(key, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError:  # pragma: no cover
+            return None
+        self._local.profiling = True
+        return profile
+
+    def _profile_process(self) -> cProfile.Profile | None:
+        with self._lock:
+            profile = self.profiles.setdefault((ALL_STAGES, None), cProfile.Profile())
+            if self._open_spans == 0:
+                try:
+                    profile.enable()
+                except ValueError:  # pragma: no cover
+                    return None
+            self._open_spans += 1
+        return profile
+
+    def _unprofile(self, profile: cProfile.Profile) -> None:
+        if PER_THREAD_PROFILES:
+            profile.disable()
+            self._local.profiling = False
+            return None
+        with self._lock:
+            self._open_spans -= 1
+            if self._open_spans == 0:
+                profile.disable()
+
+    @contextmanager
+    def span(self, stage: str, **args: Any) -> Iterator[dict[str, Any]]:
+        """Record a span of a pipeline stage, e.g. downloading a blob.
+
+        Args:
+            stage (str): Name of the stage, e.g. download.
+            **args (Any): Details of the span, e.g. the name of the blob.
+
+        Yields:
+            dict[str, Any]: The details of the span, for adding e.g. byte counts.
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        profile = self._profile(stage)
+        start, cpu_start = time.perf_counter_ns(), time.thread_time_ns()
+        try:
+            yield args
+        finally:
+            end, cpu_end = time.perf_counter_ns(), time.thread_time_ns()
+            if profile is not None:
+                self._unprofile(profile)
+            thread = threading.current_thread()
+            event = {
+                "name": stage,
+                "cat": "dims",
+                "ph": "X",
+                "ts": (start - self._start) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": {**args, "cpu_us": (cpu_end - cpu_start) / 1000},
+            }
+            with self._lock:
+                self.events.append(event)
+                self.thread_names[thread.ident] = thread.name
+
+    def trace(self) -> dict[str, Any]:
+        """Get the recorded spans in Chrome trace format.
+
+        Returns:
+            dict[str, Any]: The trace, ready to be dumped as json.
+        """
+        thread_names = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in sorted(self.thread_names.items())
+        ]
+        return {"traceEvents": thread_names + self.events}
+
+    def export(self, directory: Path) -> None:
+        """Write the trace and profiling statistics to a directory.
+
+        This writes
+            - trace.json with all spans,
+            - <stage>.<thread>.pstats with statistics per stage and thread, and
+            - <stage>.pstats with statistics per stage, across threads.
+
+        From Python 3.12, statistics per stage and thread are unavailable, and
+        all.pstats holds the statistics of all stages and threads instead.
+
+        Args:
+            directory (Path): Directory to write to.
+        """
+        if not self.enabled:
+            return None
+
+        if not PER_THREAD_PROFILES:
+            logger().warn(
+                "Profiles per stage and thread are unavailable on Python 3.12+",
+                profile=f"{ALL_STAGES}.pstats",
+            )
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "trace.json").write_text(json.dumps(self.trace()))
+        stages: dict[str, pstats.Stats] = {}
+        for (stage, thread), profile in self.profiles.items():
+            if thread is not None:
+                thread_name = re.sub(r"\W+", "_", thread).strip("_")
+                profile.dump_stats(directory / f"{stage}.{thread_name}.pstats")
+            if stage in stages:
+                stages[stage].add(profile)
+            else:
+                stages[stage] = pstats.Stats(profile)
+        for stage, stats in stages.items():
+            stats.dump_stats(directory / f"{stage}.pstats")
+        logger().info("Profile written", directory=str(directory))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+from dims import checkpoint as checkpoint_module
+from dims.checkpoint import Checkpoint
+from dims.checkpoint import open_checkpoint
+
+# --------------------------------------------------------------------------------------
+# Tests
+# --------------------------------------------------------------------------------------
+
+
+def test_checkpoint_empty(tmp_path):
+    """Without a saved checkpoint, nothing is completed."""
+    checkpoint = Checkpoint.load(tmp_path / "checkpoint")
+    assert checkpoint.directory.is_dir()
+    assert (checkpoint.completed, checkpoint.runs) == (set(), {})
+
+
+def test_checkpoint_save_load(tmp_path):
+    """Test that a saved checkpoint loads again, without runs written after it."""
+    checkpoint = Checkpoint(tmp_path)
+    run = tmp_path / "LanderVenus.run-00000.csv"
+    run.write_text("id,timestamp\r\n")
+    checkpoint.save(["a.csv", "b.csv"], {"LanderVenus": [run]})
+    orphan = tmp_path / "LanderVenus.run-00001.csv"
+    orphan.write_text("id,timestamp\r\n")
+
+    loaded = Checkpoint.load(tmp_path)
+    assert loaded.completed == {"a.csv", "b.csv"}
+    assert loaded.runs == {"LanderVenus": [run]}
+    assert run.exists()
+    assert not orphan.exists()
+
+    loaded.clear()
+    assert not tmp_path.exists()
+
+
+def test_open_checkpoint(tmp_path):
+    """Test that a previous checkpoint is only used when resuming."""
+    Checkpoint(tmp_path).save(["a.csv"], {})
+    assert open_checkpoint(tmp_path, resume=True).completed == {"a.csv"}
+    assert open_checkpoint(tmp_path).completed == set()
+
+
+def test_checkpoint_save_durable(monkeypatch, tmp_path):
+    """Test that new runs and the directory are synced, and replaced runs removed."""
+    synced = []
+    monkeypatch.setattr(checkpoint_module, "_fsync", synced.append)
+    checkpoint = Checkpoint(tmp_path)
+    runs = [tmp_path / f"LanderVenus.run-{i}.csv" for i in range(3)]
+    for run in runs:
+        run.write_text("id,timestamp\r\n")
+
+    checkpoint.save(["a.csv"], {"LanderVenus": runs[:2]})
+    assert sorted(synced[:-2]) == runs[:2]
+    assert synced[-2:] == [tmp_path, tmp_path]
+
+    # Compacted into a single run, the previous runs are no longer needed.
+    synced.clear()
+    checkpoint.save(["b.csv"], {"LanderVenus": runs[2:]})
+    assert synced == [runs[2], tmp_path, tmp_path]
+    assert [run.exists() for run in runs] == [False, False, True]
+
+
+def test_checkpoint_save_incremental(tmp_path):
+    """Test that completed blobs add up over saves, ignoring any logged after."""
+    checkpoint = Checkpoint(tmp_path)
+    checkpoint.save(["a.csv"], {})
+    checkpoint.save(["b.csv", "a.csv"], {})
+    assert checkpoint.completed == {"a.csv", "b.csv"}
+    # As if interrupted while saving, after logging a blob but before the checkpoint.
+    with (tmp_path / Checkpoint.COMPLETED_FILE).open("a") as f:
+        f.write('"c.csv"\n')
+
+    loaded = Checkpoint.load(tmp_path)
+    assert loaded.completed == {"a.csv", "b.csv"}
+    loaded.save(["d.csv"], {})
+    assert Checkpoint.load(tmp_path).completed == {"a.csv", "b.csv", "d.csv"}
+
+
+def test_checkpoint_load_leftover_directory(tmp_path):
+    """Test that directories left by an interrupted merge are removed on load."""
+    Checkpoint(tmp_path).save(["a.csv"], {})
+    leftover = tmp_path / "tmpabc123"
+    leftover.mkdir()
+    (leftover / "merged-00000.csv").write_text("id,timestamp\r\n")
+
+    checkpoint = open_checkpoint(tmp_path, resume=True)
+    assert checkpoint.completed == {"a.csv"}
+    assert not leftover.exists()
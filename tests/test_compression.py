@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+import gzip
+
+import pytest
+
+from dims.compression import detect_codec
+from dims.compression import open_bytes
+from dims.compression import open_file
+from dims.compression import suffix
+
+# --------------------------------------------------------------------------------------
+# Tests
+# --------------------------------------------------------------------------------------
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# zstd support is an optional extra, so tests depending on it are skipped without it.
+requires_zstd = pytest.mark.skipif(zstandard is None, reason="requires zstandard")
+
+
+def zstd_compress(data: bytes) -> bytes:
+    """Compress data with zstd, only once we know zstandard is installed."""
+    return zstandard.compress(data)
+
+
+CSV = "id,size\r\n1,big\r\n2,tiny\r\n"
+
+
+@pytest.mark.parametrize(
+    ["name", "content_encoding", "codec"],
+    [
+        ("lander_venus_20210301_003124.csv", None, None),
+        ("lander_venus_20210301_003124.csv", "identity", None),
+        ("lander_venus_20210301_003124.csv", "gzip", "gzip"),
+        ("lander_venus_20210301_003124.csv", "ZSTD", "zstd"),
+        ("lander_venus_20210301_003124.csv.gz", None, "gzip"),
+        ("lander_venus_20210301_003124.csv.zst", None, "zstd"),
+        ("lander_venus_20210301_003124.csv.zst", "gzip", "gzip"),
+    ],
+)
+def test_detect_codec(name, content_encoding, codec):
+    """Content encoding takes precedence over the file extension."""
+    assert detect_codec(name, content_encoding) == codec
+
+
+@pytest.mark.parametrize(
+    ["codec", "compress"],
+    [
+        (None, bytes),
+        ("gzip", gzip.compress),
+        pytest.param("zstd", zstd_compress, marks=requires_zstd),
+    ],
+)
+def test_open_bytes(codec, compress):
+    with open_bytes(compress(CSV.encode()), codec) as f:
+        assert f.read() == CSV
+
+
+@pytest.mark.parametrize(
+    "codec", [None, "gzip", pytest.param("zstd", marks=requires_zstd)]
+)
+@pytest.mark.parametrize("level", [None, 1])
+def test_open_file(codec, level, tmp_path):
+    """Test that files are compressed according to their suffix, and read back."""
+    path = tmp_path / f"test.csv{suffix(codec)}"
+    with open_file(path, "wt", level) as f:
+        f.write(CSV)
+    assert detect_codec(path.name) == codec
+    assert (path.read_bytes() == CSV.encode()) == (codec is None)
+    with open_file(path) as f:
+        assert f.read() == CSV
@@ -3,6 +3,7 @@
 # Imports
 # --------------------------------------------------------------------------------------
 import pytest
+from pydantic import ValidationError
 
 from dims.config import get_settings
 
@@ -37,3 +38,52 @@ def test_config_env(monkeypatch):
     monkeypatch.setenv("BUCKET", bucket_name)
     settings = get_settings()
     assert settings.bucket == bucket_name
+
+
+def test_config_shards(monkeypatch):
+    """Test that shard settings are validated.
+
+    The shard index must fall within the given number of shards.
+    """
+    monkeypatch.setenv("SHARD_COUNT", "4")
+    monkeypatch.setenv("SHARD_INDEX", "3")
+    settings = get_settings()
+    assert (settings.shard_index, settings.shard_count) == (3, 4)
+
+    get_settings.cache_clear()
+    monkeypatch.setenv("SHARD_INDEX", "4")
+    with pytest.raises(ValidationError):
+        get_settings()
+
+    get_settings.cache_clear()
+    monkeypatch.setenv("SHARD_COUNT", "0")
+    monkeypatch.setenv("SHARD_INDEX", "0")
+    with pytest.raises(ValidationError):
+        get_settings()
+
+
+@pytest.mark.parametrize(
+    ["codec", "level", "valid"],
+    [
+        ("gzip", "0", True),
+        ("gzip", "9", True),
+        ("gzip", "10", False),
+        ("zstd", "22", True),
+        ("zstd", "0", False),
+        ("zstd", "23", False),
+        (None, "5", False),
+    ],
+)
+def test_config_compression_level(monkeypatch, codec, level, valid):
+    """Test that the compression level is validated.
+
+    The level must be within the range of the output codec, which must be set.
+    """
+    if codec is not None:
+        monkeypatch.setenv("OUTPUT_COMPRESSION", codec)
+    monkeypatch.setenv("COMPRESSION_LEVEL", level)
+    if valid:
+        assert get_settings().compression_level == int(level)
+    else:
+        with pytest.raises(ValidationError):
+            get_settings()
@@ -3,15 +3,23 @@
 # Imports
 # --------------------------------------------------------------------------------------
 import csv
+import gzip
 from io import StringIO
 
+import pytest
 from hypothesis import given
 from hypothesis import strategies as st
 from pytest import MonkeyPatch
 from structlog.testing import capture_logs
 
+from .test_compression import requires_zstd
+from .test_compression import zstd_compress
+from dims.compression import detect_codec
+from dims.ingest import blob_shard
 from dims.ingest import get_blob_data
 from dims.ingest import get_blobs
+from dims.ingest import get_local_blobs
+from dims.ingest import iter_blob_data
 from dims.ingest import storage
 
 # --------------------------------------------------------------------------------------
@@ -56,7 +64,32 @@ def test_get_blobs(monkeypatch):
     assert {"bucket", 32} <= set(get_blobs("bucket", 32))
 
 
-@given(csv=random_csv(), blob_name=st.text())
+def test_get_local_blobs(tmp_path):
+    """Test that files in a local directory are returned as blobs, in order."""
+    source_dir = tmp_path
+    (source_dir / "subdir").mkdir()
+    for name in ["b.csv", "a.csv", "c.csv"]:
+        (source_dir / name).write_text(name)
+
+    blobs = list(get_local_blobs(source_dir))
+    assert [blob.name for blob in blobs] == ["a.csv", "b.csv", "c.csv"]
+    assert blobs[0].download_as_bytes() == b"a.csv"
+    assert len(list(get_local_blobs(source_dir, 2))) == 2
+
+
+@given(blob_name=st.text(), shard_count=st.integers(min_value=1, max_value=64))
+def test_blob_shard(blob_name, shard_count):
+    """Test that blobs are assigned to a valid shard, the same one every time."""
+    shard = blob_shard(blob_name, shard_count)
+    assert 0 <= shard < shard_count
+    assert shard == blob_shard(blob_name, shard_count)
+
+
+@given(
+    csv=random_csv(),
+    # Names with a compressed suffix would be decompressed, so leave those out.
+    blob_name=st.text().filter(lambda name: detect_codec(name) is None),
+)
 def test_get_blob_data(csv, blob_name):
     """Use random csv file objects to check that we read blob data correctly.
 
@@ -81,3 +114,63 @@ def test_get_blob_data(csv, blob_name):
             else:
                 assert blob_data.data
                 assert "timestamp" in blob_data.data[0].keys()
+
+
+@pytest.mark.parametrize(
+    ["blob_name", "content_encoding", "compress"],
+    [
+        ("lander_venus_20210301_003124.csv.gz", None, gzip.compress),
+        pytest.param(
+            "lander_venus_20210301_003124.csv.zst",
+            None,
+            zstd_compress,
+            marks=requires_zstd,
+        ),
+        ("lander_venus_20210301_003124.csv", "gzip", gzip.compress),
+        pytest.param(
+            "lander_venus_20210301_003124.csv",
+            "zstd",
+            zstd_compress,
+            marks=requires_zstd,
+        ),
+    ],
+)
+def test_get_blob_data_compressed(monkeypatch, blob_name, content_encoding, compress):
+    """Test that compressed blobs are detected and decompressed."""
+    csv_bytes = b"id,size\r\n1,big\r\n2,tiny\r\n"
+    monkeypatch.setattr(
+        storage.Blob, "download_as_bytes", lambda *args, **kwargs: compress(csv_bytes)
+    )
+    blob = storage.Blob(blob_name, "test_bucket")
+    blob.content_encoding = content_encoding
+    blob_data = get_blob_data(blob)
+    assert [d["id"] for d in blob_data.data] == ["1", "2"]
+
+
+def test_get_blob_data_corrupt(monkeypatch):
+    """Test that corrupt compressed blobs are logged and skipped."""
+    monkeypatch.setattr(
+        storage.Blob, "download_as_bytes", lambda *args, **kwargs: b"not gzip"
+    )
+    blob = storage.Blob("lander_venus_20210301_003124.csv.gz", "test_bucket")
+    with capture_logs() as log_output:
+        assert get_blob_data(blob).data == []
+        assert log_output[0]["event"] == "Failed to parse blob data"
+
+
+@pytest.mark.parametrize(
+    ["batch_size", "batch_sizes"], [(None, [3]), (2, [2, 1]), (3, [3]), (1, [1, 1, 1])]
+)
+def test_iter_blob_data(batch_size, batch_sizes):
+    """Test that blob data is read in batches of at most the batch size."""
+    csv_bytes = b"id,size\r\n1,big\r\n2,tiny\r\n3,big\r\n"
+    blob = storage.Blob("lander_venus_20210301_003124.csv", "test_bucket")
+    batches = list(iter_blob_data(blob, csv_bytes, batch_size))
+    assert [len(batch.data) for batch in batches] == batch_sizes
+    assert [row["id"] for batch in batches for row in batch.data] == ["1", "2", "3"]
+
+
+def test_iter_blob_data_empty():
+    """Test that a blob without rows gives a single empty batch."""
+    blob = storage.Blob("lander_venus_20210301_003124.csv", "test_bucket")
+    assert [batch.data for batch in iter_blob_data(blob, b"id,size\r\n", 2)] == [[]]
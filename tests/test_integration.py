@@ -2,16 +2,31 @@
 # --------------------------------------------------------------------------------------
 # Imports
 # --------------------------------------------------------------------------------------
+import gzip
+import json
+import os
+import subprocess
+import sys
 from pathlib import Path
 
 import pytest
 from structlog.testing import capture_logs
 
+from .test_compression import requires_zstd
+from .test_compression import zstd_compress
+from dims import tracing
+from dims.compression import open_file
+from dims.compression import suffix
 from dims.ingest import BlobData
+from dims.ingest import get_blob_data
+from dims.ingest import LocalBlob
 from dims.ingest import storage
 from dims.main import config
 from dims.main import main
+from dims.main import merge
 from dims.main import parse_models
+from dims.main import process_blob
+from dims.tracing import Tracer
 
 # --------------------------------------------------------------------------------------
 # Code
@@ -65,6 +80,314 @@ def test_integration_main(monkeypatch, craft_type, temp_dir):
             assert len(f.readlines()) == 1001  # header + 1000 data lines
 
 
+def test_integration_shards(monkeypatch, tmp_path):
+    """Run several sharded workers as separate processes, then merge their output.
+
+    The merged files should be identical to the output of a single unsharded run.
+    """
+    source_dir = Path(__file__).parent / "test_data"
+    sharded_dir = tmp_path / "sharded"
+    single_dir = tmp_path / "single"
+    sharded_dir.mkdir()
+    single_dir.mkdir()
+
+    shard_count = 3
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-m", "dims.main"],
+            cwd=Path(__file__).parents[1],
+            env={
+                **os.environ,
+                "SOURCE_DIR": str(source_dir),
+                "OUTPUT_DIR": str(sharded_dir),
+                "SHARD_INDEX": str(shard_index),
+                "SHARD_COUNT": str(shard_count),
+            },
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for shard_index in range(shard_count)
+    ]
+    assert [worker.wait() for worker in workers] == [0] * shard_count
+    assert all(".shard-" in path.name for path in sharded_dir.glob("*.csv"))
+
+    monkeypatch.setattr(
+        config,
+        "get_settings",
+        lambda *args: config.Settings(output_dir=sharded_dir),
+    )
+    merge()
+    monkeypatch.setattr(
+        config,
+        "get_settings",
+        lambda *args: config.Settings(source_dir=source_dir, output_dir=single_dir),
+    )
+    main()
+
+    single_files = sorted(single_dir.glob("*.csv"))
+    assert len(single_files) == 4
+    for single_file in single_files:
+        assert (sharded_dir / single_file.name).read_text() == single_file.read_text()
+
+
+def test_integration_merge_mixed_shards(monkeypatch, tmp_path):
+    """Shards left over from a run with another shard count must not be merged."""
+    for shard_file in [
+        "LanderVenus.shard-00000-of-00002.csv",
+        "LanderVenus.shard-00001-of-00002.csv",
+        "LanderVenus.shard-00002-of-00003.csv",
+    ]:
+        (tmp_path / shard_file).write_text("id,timestamp\r\n")
+    monkeypatch.setattr(
+        config, "get_settings", lambda *args: config.Settings(output_dir=tmp_path)
+    )
+    with pytest.raises(ValueError, match=r"\[2, 3\]"):
+        merge()
+    assert not (tmp_path / "LanderVenus.csv").exists()
+
+
+def test_integration_merge_duplicate_shards(monkeypatch, tmp_path):
+    """Shards left over from a run with another codec must not be merged."""
+    for shard_file in [
+        "LanderVenus.shard-00000-of-00002.csv",
+        "LanderVenus.shard-00001-of-00002.csv",
+        "LanderVenus.shard-00000-of-00002.csv.gz",
+    ]:
+        (tmp_path / shard_file).write_text("id,timestamp\r\n")
+    monkeypatch.setattr(
+        config, "get_settings", lambda *args: config.Settings(output_dir=tmp_path)
+    )
+    with pytest.raises(ValueError, match="LanderVenus.shard-00000-of-00002"):
+        merge()
+    assert not (tmp_path / "LanderVenus.csv").exists()
+
+
+def test_integration_memory_budget(monkeypatch, tmp_path):
+    """Run with a tiny memory budget, forcing batching, throttling and spilling.
+
+    The output should be identical to the output of a run without a budget.
+    """
+    source_dir = Path(__file__).parent / "test_data"
+    outputs = []
+    for memory_budget in [None, 1]:
+        output_dir = tmp_path / str(memory_budget)
+        output_dir.mkdir()
+        settings = config.Settings(
+            source_dir=source_dir, output_dir=output_dir, memory_budget=memory_budget
+        )
+        monkeypatch.setattr(config, "get_settings", lambda *args: settings)
+        with capture_logs() as log_output:
+            main()
+        assert any(log["event"] == "Peak memory usage" for log in log_output)
+        outputs.append({p.name: p.read_text() for p in output_dir.iterdir()})
+
+    assert len(outputs[0]) == 4
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize(
+    ["codec", "compress"],
+    [
+        ("gzip", gzip.compress),
+        pytest.param("zstd", zstd_compress, marks=requires_zstd),
+    ],
+)
+def test_integration_compressed(monkeypatch, tmp_path, codec, compress):
+    """Run with compressed input and output.
+
+    The decompressed output should be identical to the output of an uncompressed run.
+    """
+    data_dir = Path(__file__).parent / "test_data"
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for csv_file in data_dir.glob("*.csv"):
+        compressed = source_dir / f"{csv_file.name}{suffix(codec)}"
+        compressed.write_bytes(compress(csv_file.read_bytes()))
+
+    outputs = []
+    for source, output_compression in [(data_dir, None), (source_dir, codec)]:
+        output_dir = tmp_path / str(output_compression)
+        output_dir.mkdir()
+        settings = config.Settings(
+            source_dir=source,
+            output_dir=output_dir,
+            output_compression=output_compression,
+            compression_level=1 if output_compression else None,
+        )
+        monkeypatch.setattr(config, "get_settings", lambda *args: settings)
+        main()
+        outputs.append(
+            {p.name: open_file(p).read() for p in sorted(output_dir.iterdir())}
+        )
+
+    assert len(outputs[0]) == 4
+    assert list(outputs[1]) == [f"{name}{suffix(codec)}" for name in outputs[0]]
+    assert list(outputs[1].values()) == list(outputs[0].values())
+
+
+def test_integration_resume(monkeypatch, tmp_path):
+    """Interrupt a checkpointed run, then resume it.
+
+    Only the unfinished blobs should be processed again, and the output should be
+    identical to the output of an uninterrupted run.
+    """
+    source_dir = Path(__file__).parent / "test_data"
+    downloaded = []
+
+    def download_as_bytes(self, raw_download=False):
+        downloaded.append(self.name)
+        if self.name.startswith("rocket") and failing:
+            raise ConnectionError("Transient error")
+        return self.path.read_bytes()
+
+    monkeypatch.setattr(LocalBlob, "download_as_bytes", download_as_bytes)
+
+    outputs = []
+    for run in ["single", "resumed"]:
+        output_dir = tmp_path / run
+        output_dir.mkdir()
+        settings = config.Settings(
+            source_dir=source_dir,
+            output_dir=output_dir,
+            # A tiny budget processes blobs one at a time, in order.
+            memory_budget=1,
+            checkpoint_interval=1,
+        )
+        monkeypatch.setattr(config, "get_settings", lambda *args: settings)
+        if run == "resumed":
+            # Fail on the first rocket, after both landers are checkpointed.
+            failing = True
+            with pytest.raises(ConnectionError):
+                main()
+            settings.resume = True
+        failing = False
+        downloaded.clear()
+        main()
+        outputs.append({p.name: p.read_text() for p in output_dir.iterdir()})
+
+    assert downloaded == [
+        "rocket_saturn_20210301_121033.csv",
+        "rocket_venus_20210308_035720.csv",
+    ]
+    assert len(outputs[0]) == 4
+    assert outputs[0] == outputs[1]
+
+
+def test_integration_profile(monkeypatch, tmp_path):
+    """Run in profile mode, checking that every stage is traced and profiled."""
+    settings = config.Settings(
+        source_dir=Path(__file__).parent / "test_data",
+        output_dir=tmp_path,
+        profile=True,
+    )
+    monkeypatch.setattr(config, "get_settings", lambda *args: settings)
+    main()
+
+    stages = ["list", "download", "decode", "validate", "write"]
+    trace = json.loads((tmp_path / "profile" / "trace.json").read_text())
+    spans = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+    assert sorted({span["name"] for span in spans}) == sorted(stages)
+    for span in spans:
+        match span["name"]:
+            case "download":
+                assert span["args"]["bytes"] > 0
+            case "decode" | "validate":
+                assert span["args"]["rows"] == 1000
+            case "write":
+                assert span["args"]["rows"] == 1000
+                assert span["args"]["bytes"] > 0
+    for stage in stages if tracing.PER_THREAD_PROFILES else ["all"]:
+        assert (tmp_path / "profile" / f"{stage}.pstats").exists()
+
+
+def test_integration_profile_shards(monkeypatch, tmp_path):
+    """Test that sharded workers write their profiles to separate directories."""
+    traced_blobs = []
+    for shard_index in range(2):
+        settings = config.Settings(
+            source_dir=Path(__file__).parent / "test_data",
+            output_dir=tmp_path,
+            profile=True,
+            shard_count=2,
+            shard_index=shard_index,
+        )
+        monkeypatch.setattr(config, "get_settings", lambda *args: settings)
+        main()
+
+    for shard_index in range(2):
+        profile_dir = tmp_path / "profile" / f"shard-0000{shard_index}-of-00002"
+        trace = json.loads((profile_dir / "trace.json").read_text())
+        traced_blobs.append(
+            {
+                event["args"]["blob"]
+                for event in trace["traceEvents"]
+                if event["name"] == "download"
+            }
+        )
+        assert list(profile_dir.glob("*.pstats"))
+    # Each shard's profile covers only its own blobs.
+    assert not traced_blobs[0] & traced_blobs[1]
+    assert len(traced_blobs[0] | traced_blobs[1]) == 4
+
+
+def test_integration_profile_failing(monkeypatch, tmp_path):
+    """Test that the profile is still written when a run fails."""
+
+    def download_as_bytes(self, raw_download=False):
+        raise ConnectionError("Transient error")
+
+    monkeypatch.setattr(LocalBlob, "download_as_bytes", download_as_bytes)
+    settings = config.Settings(
+        source_dir=Path(__file__).parent / "test_data",
+        output_dir=tmp_path,
+        profile=True,
+    )
+    monkeypatch.setattr(config, "get_settings", lambda *args: settings)
+    with pytest.raises(ConnectionError):
+        main()
+
+    trace = json.loads((tmp_path / "profile" / "trace.json").read_text())
+    spans = {event["name"] for event in trace["traceEvents"] if event["ph"] == "X"}
+    assert {"list", "download"} <= spans
+
+
+def test_process_blob_batches():
+    """Test that rows are parsed in batches of at most the batch size."""
+    tracer = Tracer(enabled=True)
+    blob = LocalBlob(
+        Path(__file__).parent / "test_data" / get_test_data("lander_venus")[0]
+    )
+    name, crafts = process_blob(blob, batch_size=250, tracer=tracer)
+    assert name == blob.name
+    assert len(crafts) == 1000
+    batch_sizes = [e["args"]["rows"] for e in tracer.events if e["name"] == "validate"]
+    assert batch_sizes == [250, 250, 250, 250]
+
+
+def test_process_blob_unknown(monkeypatch, tmp_path):
+    """Blobs of unknown types are logged once, and not downloaded."""
+    monkeypatch.setattr(LocalBlob, "download_as_bytes", pytest.fail)
+    blob = LocalBlob(tmp_path / "lander_mars_20210301_003124.csv")
+    with capture_logs() as log_output:
+        assert process_blob(blob, batch_size=1) == (blob.name, [])
+    assert [log["event"] for log in log_output] == ["File not parsed"]
+
+
+def test_process_blob_invalid(tmp_path):
+    """A blob failing to parse part way through gives no crafts at all."""
+    data = Path(__file__).parent / "test_data" / get_test_data("lander_venus")[0]
+    # A truncated gzip file decompresses fine until it suddenly ends.
+    compressed = gzip.compress(data.read_bytes())
+    blob_file = tmp_path / f"{data.name}.gz"
+    blob_file.write_bytes(compressed[: len(compressed) // 2])
+    with capture_logs() as log_output:
+        assert process_blob(LocalBlob(blob_file), batch_size=300) == (
+            blob_file.name,
+            [],
+        )
+    assert log_output[-1]["event"] == "Failed to parse blob data"
+
+
 def test_parse_models():
     name = "test"
     blob_data = BlobData(name=name, data=[{"fake": "data"}])
@@ -76,3 +399,13 @@ def test_parse_models():
             "event": "File not parsed",
             "log_level": "error",
         } in log_output
+
+
+def test_parse_models_known():
+    """Blob data is parsed into the model matching the name of the blob."""
+    blob = LocalBlob(
+        Path(__file__).parent / "test_data" / get_test_data("rocket_venus")[0]
+    )
+    crafts = parse_models(get_blob_data(blob))
+    assert len(crafts) == 1000
+    assert all(type(craft).__name__ == "RocketVenus" for craft in crafts)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+import threading
+
+from hypothesis import given
+from hypothesis import strategies as st
+
+from dims import memory
+from dims.memory import InFlightLimiter
+from dims.memory import pipeline_sizes
+
+# --------------------------------------------------------------------------------------
+# Tests
+# --------------------------------------------------------------------------------------
+
+
+def test_pipeline_sizes_unbounded():
+    """Without a budget, nothing is bounded."""
+    assert pipeline_sizes(None) == (None, None, None)
+
+
+@given(headroom=st.integers(max_value=2**40))
+def test_pipeline_sizes(headroom):
+    """Test that sizes are always usable, and grow with the headroom."""
+    sizes = pipeline_sizes(headroom)
+    assert sizes.in_flight >= 1
+    assert sizes.batch_size >= 1
+    assert sizes.spill_rows >= memory.BLOB_ROWS
+
+    bigger = pipeline_sizes(max(headroom, 0) * 2)
+    assert bigger.in_flight >= sizes.in_flight
+    assert bigger.spill_rows >= sizes.spill_rows
+
+
+def test_rss():
+    """Test that we measure a plausible resident set size."""
+    # The two are sampled differently, so they can't be compared exactly.
+    assert memory.current_rss() > 0
+    assert memory.peak_rss() > 0
+
+
+def test_over_budget(monkeypatch):
+    monkeypatch.setattr(memory, "current_rss", lambda: 100)
+    assert not memory.over_budget(None)
+    assert not memory.over_budget(1000)
+    assert memory.over_budget(100)
+
+
+def test_limiter():
+    """Test that the limiter never lets more than `limit` items be in flight."""
+    limiter = InFlightLimiter(2)
+    items = limiter.throttle(range(3))
+    assert [next(items), next(items)] == [0, 1]
+
+    # The third item should only come through once one is released.
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(items))
+    thread.start()
+    thread.join(timeout=0.1)
+    assert result == []
+
+    limiter.release()
+    thread.join()
+    assert result == [2]
+    assert limiter.in_flight == 2
+
+
+def test_limiter_over_budget(monkeypatch):
+    """Test that the limiter lets one item through at a time when over budget."""
+    monkeypatch.setattr(memory, "over_budget", lambda memory_budget: True)
+    limiter = InFlightLimiter(None, memory_budget=1)
+    items = limiter.throttle(range(2))
+    assert next(items) == 0
+
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(items))
+    thread.start()
+    thread.join(timeout=0.1)
+    assert result == []
+
+    limiter.release()
+    thread.join()
+    assert result == [1]
+
+
+def test_limiter_close():
+    """Test that closing the limiter unblocks a waiting throttle."""
+    with InFlightLimiter(1) as limiter:
+        items = limiter.throttle(range(2))
+        assert next(items) == 0
+
+        result = []
+        thread = threading.Thread(target=lambda: result.extend(items))
+        thread.start()
+    thread.join()
+    assert result == []
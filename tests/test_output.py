@@ -2,16 +2,27 @@
 # --------------------------------------------------------------------------------------
 # Imports
 # --------------------------------------------------------------------------------------
+from contextlib import contextmanager
 from csv import DictReader
+from csv import DictWriter
+from uuid import uuid4
 
 import pytest
 from hypothesis import given
 from hypothesis import strategies as st
 from structlog.testing import capture_logs
 
+from .test_compression import requires_zstd
 from .test_models import craft_params
 from .test_models import craft_strats
+from dims import output
+from dims.compression import open_file
+from dims.models import RocketVenus
 from dims.output import crafts_to_csv
+from dims.output import merge_csv_shards
+from dims.output import shard_count_of
+from dims.output import shard_file
+from dims.output import SpillingSorter
 
 # --------------------------------------------------------------------------------------
 # Code
@@ -44,3 +55,157 @@ def test_crafts_to_csv_empty(temp_dir):
     with capture_logs() as log_output:
         crafts_to_csv([], test_file)
         assert {"event": "No data to output", "log_level": "warning"} in log_output
+
+
+def test_shard_file(tmp_path):
+    """Test that shard files are only used when running with several shards."""
+    assert shard_file(tmp_path, "LanderVenus", 0, 1) == tmp_path / "LanderVenus.csv"
+    assert (
+        shard_file(tmp_path, "LanderVenus", 2, 4)
+        == tmp_path / "LanderVenus.shard-00002-of-00004.csv"
+    )
+    assert shard_count_of(shard_file(tmp_path, "LanderVenus", 2, 4, "gzip")) == 4
+    assert shard_count_of(shard_file(tmp_path, "LanderVenus", 0, 1)) == 1
+
+
+@pytest.mark.parametrize(
+    "codec", [None, "gzip", pytest.param("zstd", marks=requires_zstd)]
+)
+def test_merge_csv_shards(codec, tmp_path):
+    """Test that sorted shards are merged into a single sorted csv file."""
+    shards = [
+        ["2021-03-01 00:00:01", "2021-03-01 00:00:04"],
+        ["2021-03-01 00:00:02", "2021-03-01 00:00:03", "2021-03-01 00:00:05"],
+        [],
+    ]
+    shard_files = []
+    for i, timestamps in enumerate(shards):
+        shard = shard_file(tmp_path, "Test", i, len(shards), codec)
+        with open_file(shard, "wt") as f:
+            writer = DictWriter(f, fieldnames=["id", "timestamp"])
+            writer.writeheader()
+            writer.writerows({"id": i, "timestamp": ts} for ts in timestamps)
+        shard_files.append(shard)
+
+    out_file = shard_file(tmp_path, "Test", 0, 1, codec)
+    merge_csv_shards(shard_files, out_file)
+    merged = list(DictReader(open_file(out_file)))
+    assert [row["timestamp"] for row in merged] == sorted(sum(shards, []))
+    assert [row["id"] for row in merged] == ["0", "1", "1", "0", "1"]
+
+
+def test_merge_csv_shards_limit(monkeypatch, tmp_path):
+    """With more shards than the merge limit, only so many are open at once."""
+    monkeypatch.setattr(output, "MERGE_LIMIT", 2)
+    open_files = []
+    max_open = 0
+
+    @contextmanager
+    def tracking_open_file(path, *args):
+        nonlocal max_open
+        open_files.append(path)
+        max_open = max(max_open, len(open_files))
+        with open_file(path, *args) as f:
+            yield f
+        open_files.remove(path)
+
+    monkeypatch.setattr(output, "open_file", tracking_open_file)
+    timestamps = [f"2021-03-01 00:00:{i:02d}" for i in range(7)]
+    shard_files = []
+    for i, timestamp in enumerate(reversed(timestamps)):
+        shard = shard_file(tmp_path, "Test", i, len(timestamps))
+        shard.write_text(f"id,timestamp\r\n{i},{timestamp}\r\n")
+        shard_files.append(shard)
+
+    out_file = tmp_path / "Test.csv"
+    assert merge_csv_shards(shard_files, out_file) == len(timestamps)
+    merged = list(DictReader(out_file.open()))
+    assert [row["timestamp"] for row in merged] == timestamps
+    # Two shards to read, and one file to write.
+    assert max_open == 3
+    assert {path.name for path in tmp_path.iterdir()} == {
+        *(shard.name for shard in shard_files),
+        out_file.name,
+    }
+
+
+def test_merge_csv_shards_empty(tmp_path):
+    with capture_logs() as log_output:
+        merge_csv_shards([], tmp_path / "test.csv")
+        assert {"event": "No shards to merge", "log_level": "warning"} in log_output
+
+
+@pytest.mark.parametrize("spill_rows", [None, 3, 100])
+def test_spilling_sorter(spill_rows, tmp_path):
+    """Test that crafts come out sorted by timestamp, whether spilled or not."""
+    timestamps = [f"test_20210301_00000{i}" for i in [3, 1, 4, 1, 5, 9, 2, 6]]
+    crafts = [
+        RocketVenus(id=str(uuid4()), size="10", speed=i, axis_ANGLE=0, timestamp=ts)
+        for i, ts in enumerate(timestamps)
+    ]
+    spill_dir = tmp_path / "spill"
+    spill_dir.mkdir()
+    sorter = SpillingSorter(spill_dir, spill_rows)
+    for craft in crafts:
+        sorter.add([craft])
+    if spill_rows == 100:
+        # Spill by hand, as when under memory pressure.
+        sorter.spill()
+    sorter.write(lambda key: tmp_path / f"{key}.csv")
+
+    expected = sorted(crafts, key=lambda craft: craft.timestamp)
+    from_csv = list(DictReader((tmp_path / "RocketVenus.csv").open()))
+    assert [row["speed"] for row in from_csv] == [str(c.speed) for c in expected]
+    assert bool(sorter.runs) == (spill_rows is not None)
+
+
+def test_spilling_sorter_many_runs(monkeypatch, tmp_path):
+    """Test that more runs than the merge limit are still merged in order."""
+    monkeypatch.setattr(output, "MERGE_LIMIT", 3)
+    timestamps = [f"test_20210301_0000{i:02d}" for i in range(20)]
+    crafts = [
+        RocketVenus(id=str(uuid4()), size="10", speed=i, axis_ANGLE=0, timestamp=ts)
+        for i, ts in enumerate(reversed(timestamps))
+    ]
+    sorter = SpillingSorter(tmp_path, spill_rows=1)
+    for pair in zip(crafts[::2], crafts[1::2]):
+        sorter.add(list(pair))
+    assert len(sorter.runs["RocketVenus"]) == 10
+
+    out_file = tmp_path / "out" / "RocketVenus.csv"
+    out_file.parent.mkdir()
+    sorter.write(lambda key: out_file)
+    from_csv = list(DictReader(out_file.open()))
+    expected = [str(float(speed)) for speed in reversed(range(20))]
+    assert [row["speed"] for row in from_csv] == expected
+
+
+def test_spilling_sorter_compact(monkeypatch, tmp_path):
+    """Test that compacting merges runs once there are as many as the merge limit."""
+    monkeypatch.setattr(output, "MERGE_LIMIT", 3)
+    timestamps = [f"test_20210301_00000{i}" for i in [3, 1, 4, 1, 5]]
+    crafts = [
+        RocketVenus(id=str(uuid4()), size="10", speed=i, axis_ANGLE=0, timestamp=ts)
+        for i, ts in enumerate(timestamps)
+    ]
+    sorter = SpillingSorter(tmp_path, spill_rows=0)
+    for craft in crafts[:2]:
+        sorter.add([craft])
+    sorter.compact()
+    assert len(sorter.runs["RocketVenus"]) == 2
+
+    sorter.add([crafts[2]])
+    old_runs = list(sorter.runs["RocketVenus"])
+    sorter.compact()
+    assert len(sorter.runs["RocketVenus"]) == 1
+    assert sorter.runs["RocketVenus"][0] not in old_runs
+    # Merged runs are left for the caller to remove.
+    assert all(run.exists() for run in old_runs)
+
+    sorter.add(crafts[3:])
+    out_file = tmp_path / "out" / "RocketVenus.csv"
+    out_file.parent.mkdir()
+    sorter.write(lambda key: out_file)
+    expected = sorted(crafts, key=lambda craft: craft.timestamp)
+    from_csv = list(DictReader(out_file.open()))
+    assert [row["speed"] for row in from_csv] == [str(c.speed) for c in expected]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------------
+import json
+import pstats
+import threading
+
+import pytest
+from structlog.testing import capture_logs
+
+from dims import tracing
+from dims.tracing import Tracer
+
+# --------------------------------------------------------------------------------------
+# Tests
+# --------------------------------------------------------------------------------------
+
+requires_per_thread_profiles = pytest.mark.skipif(
+    not tracing.PER_THREAD_PROFILES,
+    reason="profilers are process-wide from Python 3.12",
+)
+
+
+def trace_in_threads(tracer):
+    """Record a download span in each of two threads, open at the same time."""
+    # Keep both threads alive at once, so they do not share an ident.
+    barrier = threading.Barrier(2)
+
+    def work():
+        with tracer.span("download", blob="test") as span:
+            span["bytes"] = 42
+            barrier.wait()
+
+    threads = [threading.Thread(target=work, name=f"worker-{i}") for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_tracer_disabled(tmp_path):
+    """A disabled tracer records and writes nothing."""
+    tracer = Tracer()
+    with tracer.span("download", blob="test") as span:
+        span["bytes"] = 42
+    assert span == {"blob": "test", "bytes": 42}
+    assert tracer.events == []
+    tracer.export(tmp_path / "profile")
+    assert not (tmp_path / "profile").exists()
+
+
+def test_tracer_spans():
+    """Test that spans are recorded per thread, with their details."""
+    tracer = Tracer(enabled=True)
+    trace_in_threads(tracer)
+
+    assert len(tracer.events) == 2
+    for event in tracer.events:
+        assert event["name"] == "download"
+        assert event["ph"] == "X"
+        assert event["dur"] >= 0
+        assert event["args"]["bytes"] == 42
+        assert "cpu_us" in event["args"]
+    # Threads are named in the trace, even though they have exited by now.
+    names = {e["args"]["name"] for e in tracer.trace()["traceEvents"] if e["ph"] == "M"}
+    assert names == {"worker-0", "worker-1"}
+
+
+@requires_per_thread_profiles
+def test_tracer_profiles_per_thread(tmp_path):
+    """Test that spans are profiled per stage and thread."""
+    tracer = Tracer(enabled=True)
+    trace_in_threads(tracer)
+    assert set(tracer.profiles) == {("download", "worker-0"), ("download", "worker-1")}
+
+    # Statistics are written per thread, and added up per stage.
+    tracer.export(tmp_path)
+    assert {path.name for path in tmp_path.glob("*.pstats")} == {
+        "download.pstats",
+        "download.worker_0.pstats",
+        "download.worker_1.pstats",
+    }
+
+
+def test_tracer_profiles_process(monkeypatch, tmp_path):
+    """Test that a single profiler is used where profilers are process-wide."""
+    monkeypatch.setattr(tracing, "PER_THREAD_PROFILES", False)
+    tracer = Tracer(enabled=True)
+    trace_in_threads(tracer)
+    with tracer.span("write"):
+        with tracer.span("validate"):
+            sum(range(1000))
+    assert list(tracer.profiles) == [("all", None)]
+
+    with capture_logs() as log_output:
+        tracer.export(tmp_path)
+    assert log_output[0]["log_level"] == "warning"
+    assert [path.name for path in tmp_path.glob("*.pstats")] == ["all.pstats"]
+    assert pstats.Stats(str(tmp_path / "all.pstats")).total_calls > 0
+
+
+@requires_per_thread_profiles
+def test_tracer_nested_spans():
+    """Nested spans are recorded, but only profiled as part of the outer span."""
+    tracer = Tracer(enabled=True)
+    with tracer.span("write"):
+        with tracer.span("validate"):
+            pass
+    assert [event["name"] for event in tracer.events] == ["validate", "write"]
+    assert [stage for stage, _ in tracer.profiles] == ["write"]
+
+
+@requires_per_thread_profiles
+def test_tracer_export(tmp_path):
+    """Test that the trace and profiling statistics are written."""
+    tracer = Tracer(enabled=True)
+    for stage in ["download", "decode", "download"]:
+        with tracer.span(stage):
+            sum(range(1000))
+
+    tracer.export(tmp_path)
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    events = trace["traceEvents"]
+    assert [event["name"] for event in events] == [
+        "thread_name",
+        "download",
+        "decode",
+        "download",
+    ]
+    assert events[0]["args"]["name"] == "MainThread"
+    for name in ["download.pstats", "decode.pstats", "download.MainThread.pstats"]:
+        assert pstats.Stats(str(tmp_path / name)).total_calls > 0